@@ -1,46 +1,150 @@
+import os
 import sys
 import json
+import pickle
+import struct
+import operator
 import pathlib
-import xml.etree.ElementTree as ET
+from importlib import metadata
+try:
+    # lxml's C parser is considerably faster on large register maps, but is optional
+    from lxml import etree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
 import logging
 from typing import Union, TypeAlias
+from enum import IntEnum
 
-from dataclasses import dataclass, field, fields, _MISSING_TYPE
+from dataclasses import dataclass, field
+from functools import lru_cache
 from collections.abc import Iterable
 
 from RegisterAccessor.base.base_controller import BaseError
 
-@dataclass
+_BYTEORDER = sys.byteorder  # resolved once, rather than on every register access
+
+# precompiled structs for converting common register sizes to/from ints, in native byte order
+_INT_STRUCTS = {1: struct.Struct("=B"), 2: struct.Struct("=H"), 4: struct.Struct("=I"), 8: struct.Struct("=Q")}
+
+class Policy(IntEnum):
+    """Access Policies, defining how the adapter reads a Register"""
+    STATIC = 0  # read once, then return the saved value
+    POLLED = 1  # read periodically in the background
+    IMMEDIATE = 2  # read from the device on every access
+
+    @classmethod
+    def from_name(cls, name: "str | Policy") -> "Policy":
+        """Resolve a policy name, or one of its aliases, to a Policy. Case insensitive"""
+        if isinstance(name, cls):
+            return name
+        try:
+            return _POLICY_NAMES[name.lower()]
+        except KeyError:
+            raise ValueError("Access Policy '%s' not recognised" % name) from None
+
+
+_POLICY_NAMES = {
+    "static": Policy.STATIC,
+    "once": Policy.STATIC,
+    "polled": Policy.POLLED,
+    "looped": Policy.POLLED,
+    "immediate": Policy.IMMEDIATE,
+    "direct": Policy.IMMEDIATE
+}
+
+
+DEFAULT_DESC = "No Description Provided"
+DEFAULT_PERMISSION = "r"
+
+# (readable, writeable) for each permission string seen. There are only ever a handful of distinct values
+_PERM_CACHE: dict[str, tuple[bool, bool]] = {}
+
+
+@dataclass(slots=True)
 class Memory:
     """Base Data Class, for inheritance only"""
     name: str
-    desc: str = "No Description Provided"
-    permission: str = "r"
+    desc: str = DEFAULT_DESC
+    permission: str = DEFAULT_PERMISSION
+    read: bool = field(default=False, init=False)
+    write: bool = field(default=False, init=False)
 
     def __post_init__(self):
-        for classField in fields(self):
-            if not isinstance(classField.default, _MISSING_TYPE) and getattr(self, classField.name) is None:
-                setattr(self, classField.name, classField.default)
-        self.read = "r" in self.permission.lower()
-        self.write = "w" in self.permission.lower()
+        # XML maps may leave these attributes out, in which case the parser passes None
+        if self.desc is None:
+            self.desc = DEFAULT_DESC
+        if self.permission is None:
+            self.permission = DEFAULT_PERMISSION
+        perms = _PERM_CACHE.get(self.permission)
+        if perms is None:
+            lower = self.permission.lower()
+            perms = _PERM_CACHE[self.permission] = ("r" in lower, "w" in lower)
+        self.read, self.write = perms
 
 
-@dataclass
+@dataclass(slots=True)
 class BitField(Memory):
     """Data Class for the bitfields within a Register"""
     mask: int = 0  # a mask for the bits the field relate to
+    shift: int = field(default=0, init=False)  # number of trailing zeros on the mask
+    inv_mask: int = field(default=0, init=False)
+    word_index: int = field(default=-1, init=False)  # index of the 32 bit word containing the field, -1 if it spans words
+    word_mask: int = field(default=0, init=False)  # mask and shift relative to that word
+    word_shift: int = field(default=0, init=False)
+
+    def __post_init__(self):
+        Memory.__post_init__(self)  # zero argument super() doesn't work with slots dataclasses
+        # precalculate the shift and inverse mask, so field access doesn't need to recalculate them
+        self.shift = (self.mask & -self.mask).bit_length() - 1 if self.mask else 0
+        self.inv_mask = ~self.mask
+        word_index = self.shift // 32
+        if self.mask and (self.mask.bit_length() - 1) // 32 == word_index:
+            self.word_index = word_index
+            self.word_mask = self.mask >> (word_index * 32)
+            self.word_shift = self.shift - word_index * 32
 
 
-@dataclass
+@dataclass(slots=True)
 class Register(Memory):
     """Register Data Class, stores the addr, name, size, read/write permissions, description and any bitfields"""
     addr: int = 0  # absolute addr offset
     size: int = 4  # number bytes, default 32 bit reg
-    bitFields: list[BitField] = field(default_factory=list)
-    policy: str = ""  # defines how the adapter accesses the Register
+    bitFields: dict[str, BitField] = field(default_factory=dict)
+    policy: Policy | None = None  # defines how the adapter accesses the Register. None uses the adapter default
     poll_freq: int = 0  # millisecond frequency for Polled Registers only
-    timeLastRead: int = 0  # only used for Polled registers
+    readback_after_write: bool = False  # read the register back after writing, for registers that don't hold the written value
+    timeLastRead: int = 0  # only used for Polled registers, in monotonic milliseconds
     value: bytearray = field(default_factory=bytearray)
+    int_value: int = 0  # integer form of value, kept in sync whenever value is updated
+    loaded: bool = field(default=False, init=False)  # has the value been read from/written to the device yet
+
+    def __post_init__(self):
+        Memory.__post_init__(self)
+        # map files store the policy by name, resolve it once here rather than comparing strings on access
+        if isinstance(self.policy, str):
+            self.policy = Policy.from_name(self.policy) if self.policy else None
+        # preallocate the value buffer, so reads can fill it in place rather than creating a new one each time
+        if not self.value:
+            self.value = bytearray(self.size)
+
+    def update_from_buffer(self):
+        """Update the cached integer value after the value buffer has been filled"""
+        packer = _INT_STRUCTS.get(self.size)
+        if packer and len(self.value) == self.size:
+            self.int_value = packer.unpack_from(self.value)[0]
+        else:
+            self.int_value = int.from_bytes(self.value, _BYTEORDER)
+        self.loaded = True
+
+    def update_from_int(self, value: int):
+        """Pack an integer into the value buffer, and update the cached integer value"""
+        packer = _INT_STRUCTS.get(self.size)
+        if packer and len(self.value) == self.size:
+            packer.pack_into(self.value, 0, value)
+        else:
+            self.value[:] = value.to_bytes(self.size, _BYTEORDER)
+        self.int_value = value
+        self.loaded = True
 
 
 class RegisterMapError(BaseError):
@@ -55,6 +159,21 @@ PERM_KEY = "permission"
 MASK_KEY = "mask"
 SIZE_KEY = "size"
 
+@lru_cache(maxsize=1024)
+def _parse_mask(mask: str) -> int:
+    """Parse a hex bitfield mask. Cached, as the same few masks appear on many registers in a map"""
+    return int(mask, 16)
+
+
+@lru_cache(maxsize=1)
+def _package_version() -> str | None:
+    """The installed version of this package, so cached register maps are discarded when it is upgraded"""
+    try:
+        return metadata.version("RegisterAccessor")
+    except metadata.PackageNotFoundError:
+        return None
+
+
 RegisterMapDict: TypeAlias = dict[str, Union[Register, 'RegisterMapDict']]
 """Type Desription for the ensted Register map dictionary"""
 
@@ -64,12 +183,14 @@ class RegisterMap():
     into a nested dictionary tree structure containing Registers
     """
     supported_file_types = [".xml", ".json"]
+    cache_version = 1  # increase when the parsed structure changes, so older cache files are ignored
 
     def __init__(self, reg_file: str, policy_file: str | None = None) -> None:
         self.reg_file = pathlib.Path(reg_file)
         self.policy_file = pathlib.Path(policy_file) if policy_file else None
 
         self.map: RegisterMapDict
+        self.device_size: int | None = None  # size of the register space in bytes, if the map file defines it
         if not self.reg_file.is_file():
             raise RegisterMapError("Register Map File \"%s\" is not found", reg_file)
         if self.reg_file.suffix not in self.supported_file_types:
@@ -90,88 +211,233 @@ class RegisterMap():
         else:
             raise RegisterMapError("Register Map File \"%s\" is invalid file type", reg_file)
         
-        # register map now saved and standardised between file types. Apply any additional policy overwrites
+        # register map now saved and standardised between file types. Index it for quick lookups by name or path
+        self._by_name, self._by_path = self._build_index(self.map)
+        self.registers: dict[int, Register] = {reg.addr: reg for reg in self._by_path.values()}
+
+        # Apply any additional policy overwrites
         for regName, policy in self.policy_overwrites.items():
             try:
-                regs = self.getReg(regName, self.map)
-                for reg in regs:
-                    reg.policy = policy.get("policy", reg.policy)
-                    reg.poll_freq = policy.get("frequency", reg.poll_freq)
+                regs = self.getReg(regName)
             except RegisterMapError:
                 logging.warning("Register: %s not found in map, cannot apply policy", regName)
+                continue
+            for reg in regs:
+                if "policy" in policy:
+                    try:
+                        reg.policy = Policy.from_name(policy["policy"])
+                    except ValueError:
+                        raise RegisterMapError("Access Policy \"%s\" for Register %s (0x%X) in \"%s\" not recognised",
+                                               policy["policy"], regName, reg.addr, self.policy_file) from None
+                reg.poll_freq = policy.get("frequency", reg.poll_freq)
+                reg.readback_after_write = policy.get("readback", reg.readback_after_write)
+
+    @classmethod
+    def load_or_parse(cls, reg_file: str, policy_file: str | None = None, cache_dir: str | None = None) -> "RegisterMap":
+        """
+        Load an XML Register Map from a pickled cache file in cache_dir, if it was made by the same version of this
+        package from the current versions of the map and policy files. Otherwise parse the files, and save the
+        result in the cache for next time. JSON maps are quick enough to load that they are never cached.
+        The cache is unpickled when loaded, so cache_dir should only be writeable by trusted users
+
+        :param reg_file: Path to the XML or JSON register map file
+        :type reg_file: str
+        :param policy_file: Path to the (optional) JSON access policy file
+        :type policy_file: str | None
+        :param cache_dir: Directory to keep the cache file in. If None, the map is always parsed
+        :type cache_dir: str | None
+        :return: The parsed Register Map
+        :rtype: RegisterMap
+        """
+        reg_path = pathlib.Path(reg_file)
+        if not cache_dir or reg_path.suffix != ".xml":
+            return cls(reg_file, policy_file)
+        policy_path = pathlib.Path(policy_file) if policy_file else None
+        try:
+            key = (cls.cache_version, _package_version(),
+                   str(reg_path.resolve()), reg_path.stat().st_mtime_ns,
+                   str(policy_path.resolve()) if policy_path else None,
+                   policy_path.stat().st_mtime_ns if policy_path and policy_path.exists() else None)
+        except OSError:
+            # let the parser report the missing file
+            return cls(reg_file, policy_file)
+
+        cache_path = pathlib.Path(cache_dir).joinpath(reg_path.name + ".cache.pkl")
+        try:
+            with open(cache_path, "rb") as f:
+                cached_key, reg_map = pickle.load(f)
+            if cached_key == key:
+                logging.debug("Loaded Reg map from cache %s", cache_path)
+                return reg_map
+        except FileNotFoundError:
+            pass
+        except Exception as error:
+            # a corrupt or incompatible cache just means the map is parsed again
+            logging.warning("Unable to load register map cache %s: %s", cache_path, error)
+
+        reg_map = cls(reg_file, policy_file)
+        tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                pickle.dump((key, reg_map), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)  # so a partially written cache is never read
+        except OSError as error:
+            logging.warning("Unable to write register map cache %s: %s", cache_path, error)
+        return reg_map
+
+    def get_schema(self) -> str:
+        """
+        Get the register map serialised as JSON
+
+        :return: The JSON register map, in the format written by the map generator
+        :rtype: str
+        """
+        return json.dumps(self.map, indent=2, cls=RegisterEncoder)
+
+    def get_paths(self) -> dict[str, Register]:
+        """
+        Get every register in the map, keyed by its full path (without a leading "/")
+
+        :return: A flat dict of register paths and their Registers
+        :rtype: dict[str, Register]
+        """
+        return self._by_path
+
+    def _build_index(self, map: RegisterMapDict) -> tuple[dict[str, list[Register]], dict[str, Register]]:
+        """
+        Walk the Register Map once, building lookup tables of registers by name and by full path
+
+        :param map: Register Map Dictionary to index
+        :type map: RegisterMapDict
+        :return: A dict of Register lists keyed by register name, and a dict of Registers keyed by path
+        :rtype: tuple[dict[str, list[Register]], dict[str, Register]]
+        """
+        by_name: dict[str, list[Register]] = {}
+        by_path: dict[str, Register] = {}
+
+        def index_node(prefix: str, node: RegisterMapDict):
+            for k, v in node.items():
+                if isinstance(v, Register):
+                    by_name.setdefault(k, []).append(v)
+                    by_path[prefix + k] = v
+                elif isinstance(v, dict):
+                    index_node(prefix + k + "/", v)
+
+        index_node("", map)
+        return by_name, by_path
 
     def read_xml_map(self, path: pathlib.Path):
-        root = ET.parse(path).getroot()
-        return self.parseXMLElement(root)
+        """
+        Stream the XML file with iterparse, building the register map as each element is closed.
+        Elements are cleared once converted, so the full XML tree is never held in memory at once
+        """
+        # stack of the (attributes, parsed node) pairs for the children of each currently open element
+        stack: list[list[tuple[dict[str, str], RegisterMapDict | Register | None]]] = [[]]
+        for event, element in ET.iterparse(path, events=("start", "end")):
+            if event == "start":
+                stack.append([])
+            else:
+                children = stack.pop()
+                info = dict(element.attrib)  # copied once, as lxml builds a new attrib proxy on every access
+                if NAME_KEY in info:
+                    # names are repeated across the map (and used as tree/index keys), so share one copy of each
+                    info[NAME_KEY] = sys.intern(info[NAME_KEY])
+                stack[-1].append((info, self.parseXMLElement(info, children) if children else None))
+                element.clear()
+
+        root_info, root = stack[0][0]
+        if "byte_size" in root_info:
+            self.device_size = int(root_info["byte_size"])
+        return root if root is not None else self.parseXMLElement(root_info, [])
 
     def read_json_map(self, path: pathlib.Path):
         with open(path) as f:
             json_tree = json.load(f)
         return self.parseJSONElement("", json_tree)
 
-    def parseXMLElement(self, element: ET.Element) -> RegisterMapDict:
-        info = element.attrib
-        fields_list: list[BitField] = []
-        if len(element):
-            first_child = element[0].attrib
+    def parseXMLElement(self, info: dict[str, str],
+                        children: list[tuple[dict[str, str], RegisterMapDict | Register | None]]) -> RegisterMapDict:
+        """
+        Convert a closed XML element into a Register or a dict of subregisters, based on its already parsed children.
+        Children without children of their own are passed as None, as whether they are a Register or
+        a BitField depends on their parent.
+        """
+        fields_dict: dict[str, BitField] = {}
+        if children:
+            first_child = children[0][0]
             if MASK_KEY in first_child and "address" not in first_child and first_child.get(ADDR_KEY) == info.get(ADDR_KEY):
                 # fields of the register
-                for fieldElement in element:
-                    field_info = fieldElement.attrib
-                    field = BitField(name=field_info.get(NAME_KEY),
-                                     desc=field_info.get(DESC_KEY),
-                                     permission=field_info.get(PERM_KEY),
-                                     mask=int(field_info.get(MASK_KEY), 16))
-
-                    fields_list.append(field)
+                for field_info, _ in children:
+                    get = field_info.get
+                    name = get(NAME_KEY)
+                    fields_dict[name] = BitField(name=name,
+                                                 desc=get(DESC_KEY),
+                                                 permission=get(PERM_KEY),
+                                                 mask=_parse_mask(get(MASK_KEY)))
 
             else:
                 # subregisters inside area
                 node = {}
-                for reg in element:
-                    node[reg.attrib.get(NAME_KEY)] = self.parseXMLElement(reg)
-                
+                for reg_info, reg in children:
+                    node[reg_info.get(NAME_KEY)] = reg if reg is not None else self.parseXMLElement(reg_info, [])
+
                 return node
 
-        reg = Register(name=info.get(NAME_KEY),
-                       desc=info.get(DESC_KEY),
-                       permission=info.get(PERM_KEY),
-                       addr=int(info.get(ADDR_KEY), 16),
-                       size=int(info.get(SIZE_KEY, 1)) * 4,
-                       bitFields=fields_list)
-        
+        get = info.get
+        reg = Register(name=get(NAME_KEY),
+                       desc=get(DESC_KEY),
+                       permission=get(PERM_KEY),
+                       addr=int(get(ADDR_KEY), 16),
+                       size=int(get(SIZE_KEY, 1)) * 4,
+                       bitFields=fields_dict)
+
         return reg
 
     def parseJSONElement(self, name: str, element: dict) -> RegisterMapDict:
+        """
+        Convert a JSON register map (or part of one) into a Register or nested dict of Registers.
+        Walks the tree with an explicit stack rather than recursing, to avoid a function call per node
+        """
         if "addr" in element:
-            # Register!
-            fields_list: list[BitField] = []
-            for field_name, field_info in element.get("fields", {}).items():
-                fields_list.append(BitField(name=field_name,
-                                            desc=field_info.get("desc"),
-                                            permission=field_info.get("permission"),
-                                            mask=field_info.get("mask")))
-
-            reg = Register(name=name,
-                           desc=element.get("desc"),
-                           permission=element.get("permission"),
-                           addr=element.get("addr"),
-                           size=element.get("size"),
-                           policy=element.get("access_policy"),
-                           poll_freq=element.get("poll_rate"),
-                           bitFields=fields_list
-                           )
-            return reg
-        else:
-            node = {}
-            for reg_name, reg_dict in element.items():
-                node[reg_name] = self.parseJSONElement(reg_name, reg_dict)
-            
-            return node
-    
+            return self.parseJSONRegister(name, element)
+
+        root: RegisterMapDict = {}
+        stack = [(root, element, name)]
+        while stack:
+            node, json_node, prefix = stack.pop()
+            for reg_name, reg_dict in json_node.items():
+                path = prefix + "/" + reg_name if prefix else reg_name
+                if "addr" in reg_dict:
+                    node[reg_name] = self.parseJSONRegister(reg_name, reg_dict, path)
+                else:
+                    # area containing more registers, added now to keep the map in file order
+                    node[reg_name] = {}
+                    stack.append((node[reg_name], reg_dict, path))
+        return root
+
+    def parseJSONRegister(self, name: str, element: dict, path: str | None = None) -> Register:
+        policy = element.get("access_policy")
+        if policy:
+            try:
+                Policy.from_name(policy)
+            except ValueError:
+                raise RegisterMapError("Access Policy \"%s\" for Register %s (0x%X) in \"%s\" not recognised",
+                                       policy, path or name, element["addr"], self.reg_file) from None
+        fields_dict: dict[str, BitField] = {}
+        for field_name, field_info in element.get("fields", {}).items():
+            # only pass the keys present, so the dataclass defaults fill in the rest
+            fields_dict[field_name] = BitField(name=field_name,
+                                               **{attr: field_info[key] for key, attr in _JSON_FIELD_KEYS if key in field_info})
+
+        reg = Register(name=name,
+                       bitFields=fields_dict,
+                       **{attr: element[key] for key, attr in _JSON_REG_KEYS if key in element})
+        return reg
+
     def getReg(self, path: str, map: RegisterMapDict | None = None) -> Iterable[Register]:
         """
-        Get an iterator of all registers that match with the Path provided
+        Get a list of all registers that match with the Path provided
         If path contains a "/", it is assumed to be a full path to a specific reg
         If not, it is assumed to be just the name of the register(s) desired
 
@@ -179,56 +445,63 @@ class RegisterMap():
         :type path: str
         :param map: Register Map Dictionary to search through. If None provided, uses `self.map`
         :type map: RegisterMapDict | None
-        :return: A generator/iterable of Registers.
+        :return: A list of Registers.
         :rtype: Iterable[Register]
 
         :raises RegisterMapError: If the path provided does not resolve to a Register in the map
         """
-        subMap = map if map is not None else self.map
+        if map is None or map is self.map:
+            by_name, by_path = self._by_name, self._by_path
+        else:
+            by_name, by_path = self._build_index(map)
+
         if "/" in path:
             # is a direct path
-            split_path = path.split("/")
-            if split_path[-1] == "":
-                del split_path[-1]
-            for path in split_path:
-                try:
-                    if isinstance(subMap, dict):
-                        subMap = subMap[path]
-                    if isinstance(subMap, Register):
-                        yield subMap
-                except (KeyError, ValueError):
-                    raise RegisterMapError("Invalid Path: %s", path)
+            reg = by_path.get(path.strip("/"))
+            regs = [reg] if reg is not None else []
         else:
             # is just the register name. Return all registers with that name
-            for k, v in subMap.items():
-                if k == path and isinstance(v, Register):
-                    yield v
-                elif isinstance(v, dict):
-                    for result in self.getReg(path, v):
-                        yield result
+            regs = by_name.get(path, [])
+
+        if not regs:
+            raise RegisterMapError("Invalid Path: %s", path)
+        return regs
+
+
+# (JSON key, dataclass attribute) pairs for the optional values of Registers and BitFields
+_JSON_REG_KEYS = (("desc", "desc"), ("permission", "permission"), ("addr", "addr"), ("size", "size"),
+                  ("access_policy", "policy"), ("poll_rate", "poll_freq"), ("readback", "readback_after_write"))
+_JSON_FIELD_KEYS = (("desc", "desc"), ("permission", "permission"), ("mask", "mask"))
+
+_reg_getter = operator.attrgetter("addr", "size", "desc", "permission", "policy", "poll_freq", "readback_after_write",
+                                  "bitFields")
+_field_getter = operator.attrgetter("name", "permission", "desc", "mask")
 
 
 class RegisterEncoder(json.JSONEncoder):
     """Custom JSON encoder to allow the Register data class to be JSON serializable"""
     def default(self, o):
         if isinstance(o, Register):
+            addr, size, desc, permission, policy, poll_freq, readback, bitFields = _reg_getter(o)
             reg_dict = {
-             "addr": o.addr,
-             "size": o.size,
-             "desc": o.desc,
-             "permission": o.permission
+             "addr": addr,
+             "size": size,
+             "desc": desc,
+             "permission": permission
             }
-            if o.policy:
-                reg_dict["access_policy"] = o.policy
-            if o.poll_freq:
-                reg_dict["poll_rate"] = o.poll_freq
-            if o.bitFields:
+            if policy is not None:
+                reg_dict["access_policy"] = policy.name.lower()
+            if poll_freq:
+                reg_dict["poll_rate"] = poll_freq
+            if readback:
+                reg_dict["readback"] = readback
+            if bitFields:
                 reg_dict['fields'] = {
-                    bitField.name: {
-                        "permission": bitField.permission,
-                        "desc": bitField.desc,
-                        "mask": bitField.mask
+                    name: {
+                        "permission": permission,
+                        "desc": desc,
+                        "mask": mask
                     }
-                    for bitField in o.bitFields}
+                    for name, permission, desc, mask in map(_field_getter, bitFields.values())}
             return reg_dict
-        return super().default(self, o)
+        return super().default(o)
@@ -1,6 +1,7 @@
-from ctypes import CDLL, pointer, POINTER, Structure
+from ctypes import CDLL, pointer, POINTER, Structure, byref
 from ctypes import c_uint, c_int, c_uint8, c_uint32, c_uint64, c_bool, c_size_t, c_void_p
 from ctypes.util import find_library
+import threading
 from RegisterAccessor.base.base_mem_accessor import RegisterAccessorException
 
 
@@ -70,3 +71,29 @@ class AdxdmaLib(CDLL):
         self.ADXDMA_Close.argtypes = [c_int]
         self.ADXDMA_ReadWindow.argtypes = [c_int, c_uint32, c_uint8, c_uint64, c_size_t, c_void_p, POINTER(COMPLETION)]
         self.ADXDMA_WriteWindow.argtypes = [c_int, c_uint32, c_uint8, c_uint64, c_size_t, c_void_p, POINTER(COMPLETION)]
+
+        self._local = threading.local()
+
+    def get_completion(self) -> tuple[COMPLETION, object]:
+        """
+        Get the COMPLETION struct for the calling thread, and a reference to it to pass to read/write calls.
+        These are created once per thread and then reused, rather than created for every read/write
+        """
+        local = self._local
+        if not hasattr(local, "completion"):
+            local.completion = COMPLETION()
+            local.completion_ref = byref(local.completion)
+        return local.completion, local.completion_ref
+
+    def read_into(self, window_handle: c_int, offset: int, buf: bytearray, size: int | None = None) -> int:
+        """
+        Read from an open window directly into a writeable buffer (such as a bytearray), without
+        an intermediate copy. The buffer should be a multiple of 4 bytes, as reads are done in 32 bit words.
+        The completion details of the read are available from `get_completion`
+
+        :param size: The number of bytes to read into the start of the buffer. Defaults to the whole buffer
+        :return: The ADXDMA status code of the read
+        """
+        c_buf = (c_uint8 * len(buf)).from_buffer(buf)
+        return self.ADXDMA_ReadWindow(window_handle, 0, 4, offset, len(buf) if size is None else size,
+                                      c_buf, self.get_completion()[1])
@@ -4,7 +4,6 @@ from ctypes import byref
 from ctypes import c_int, c_uint32
 
 import logging
-import math
 
 
 class AdxdmaException(RegisterAccessorException):
@@ -67,6 +66,8 @@ class AdxdmaAccessor(RegisterAccessor):
 
         self.deviceHandle = c_int()
         self.windowHandle = c_int()
+        # ctypes word array types, by number of words, so writes don't need to look them up each time
+        self._array_types: dict[int, type] = {}
 
     def open(self) -> None:
 
@@ -85,27 +86,40 @@ class AdxdmaAccessor(RegisterAccessor):
             self.close()
 
     def read(self, addr: int, size: int) -> bytearray:
+        buf = bytearray(size)
+        self.read_into(addr, buf)
+        return buf
+
+    def read_into(self, addr: int, buf: bytearray) -> None:
         if not self.isConnected:
             raise AdxdmaException(self.lib.DEVICE_NOT_FOUND)
-        complete = COMPLETION()
-        num_words = math.ceil(size / 4)
-        buf = bytearray(4 * num_words)
-        # we are insisting on 4 byte word reads, but that wont effect the returned bytearray
-        point = (c_uint32 * num_words).from_buffer(buf)
-
-        status = self.lib.ADXDMA_ReadWindow(self.windowHandle, 0, 4, addr, size, point, byref(complete))
-        self._testStatus(status, complete)
-
-        return buf[:size]
+        size = len(buf)
+        if size % 4:
+            # reads are done in 4 byte words, so buffers that aren't word aligned are read through a padded copy
+            padded = bytearray((size + 3) & ~3)
+            status = self.lib.read_into(self.windowHandle, addr, padded, size)
+            self._testStatus(status, self.lib.get_completion()[0])
+            buf[:] = padded[:size]
+            return
+        status = self.lib.read_into(self.windowHandle, addr, buf)
+        self._testStatus(status, self.lib.get_completion()[0])
 
     def write(self, addr: int, data: bytearray) -> None:
         if not self.isConnected:
             raise AdxdmaException(self.lib.DEVICE_NOT_FOUND)
-        complete = COMPLETION()
-        num_words = math.ceil(len(data) / 4)
-
-        point = (c_uint32 * num_words).from_buffer(data)
-        status = self.lib.ADXDMA_WriteWindow(self.windowHandle, 0, 4, addr, len(data), point, byref(complete))
+        complete, complete_ref = self.lib.get_completion()
+        num_words = (len(data) + 3) >> 2
+        array_type = self._array_types.get(num_words)
+        if array_type is None:
+            array_type = self._array_types[num_words] = c_uint32 * num_words
+
+        if type(data) is bytearray and len(data) == num_words * 4:
+            point = array_type.from_buffer(data)  # no copy needed
+        else:
+            # read only (e.g. bytes) or not a whole number of words, so copy into a padded word array.
+            # only len(data) bytes are written, so the padding is never sent
+            point = array_type.from_buffer_copy(bytes(data).ljust(num_words * 4, b"\0"))
+        status = self.lib.ADXDMA_WriteWindow(self.windowHandle, 0, 4, addr, len(data), point, complete_ref)
         self._testStatus(status, complete)
 
     def _testStatus(self, status, complete: COMPLETION | None = None):
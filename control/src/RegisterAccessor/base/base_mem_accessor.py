@@ -32,3 +32,10 @@ class RegisterAccessor(ABC):
     @abstractmethod
     def write(self, addr: int, data: bytearray) -> None:
         pass
+
+    def read_into(self, addr: int, buf: bytearray) -> None:
+        """
+        Read len(buf) bytes from the address directly into the provided buffer.
+        Accessors should override this if they can fill the buffer without creating an intermediate copy
+        """
+        buf[:] = self.read(addr, len(buf))
@@ -2,40 +2,23 @@ import logging
 import sys
 import json
 import time
-import math
+import heapq
+import threading
+import struct
 from odin.adapters.parameter_tree import ParameterTree, ParameterTreeError
-import xml.etree.ElementTree as ET
-from functools import partial
-from dataclasses import dataclass, fields, field, _MISSING_TYPE
-from tornado.ioloop import PeriodicCallback
 from typing import TypedDict, Callable
 
 from .base.base_controller import BaseController, BaseError
 from .base.base_mem_accessor import RegisterAccessor
 from RegisterAccessor.adxdma.accessor import AdxdmaAccessor
 from RegisterAccessor.xdma.accessor import XDmaAccessor
-from RegisterAccessor.RegisterMap import RegisterMap, RegisterMapError, Register, BitField
+from RegisterAccessor.RegisterMap import RegisterMap, RegisterMapError, Register, BitField, Policy
 
 
-def _get_bitwise_trailing_zeros(val):
-    """Method to get the number of trailing 0s on a binary value.
-    Used to calculate how much to shift a masked value to return the specific value regardless of its position"""
-    c = 0
-    v = (val ^ (val - 1)) >> 1
-    while v > 0:
-        v >>= 1
-        c += 1
-    return c
+_BYTEORDER = sys.byteorder  # resolved once, rather than on every register access
 
-
-# attribute key consts for the XMl parsing, based on the XML firmware file
-NAME_KEY = "id"
-FULLNAME_KEY = "absolute_id"
-ADDR_KEY = "absolute_offset"
-DESC_KEY = "description"
-PERM_KEY = "permission"
-MASK_KEY = "mask"
-SIZE_KEY = "size"
+# little endian 32 bit word, for extracting bitfields from wide registers
+_WORD_STRUCT = struct.Struct("<I")
 
 
 class ControllerError(BaseError):
@@ -63,38 +46,72 @@ class RegisterAccessorController(BaseController):
             options.get("accessor_type", "xdma").lower(), XDmaAccessor)
 
         # get register access policy settings
-        self.access_policy = options.get("access_policy", "static")
+        try:
+            self.access_policy = Policy.from_name(options.get("access_policy", "static"))
+        except ValueError as error:
+            raise ControllerError(error)
         policy_file_name = options.get("access_policy_file")
 
         self.poll_rate = int(options.get("poll_rate", 1000))
+        self.read_on_open = str(options.get("read_on_open", False)).lower() in ["true", "1", "yes"]
 
         # get register map
         reg_map_file = options.get("reg_map")
-        self.register_map = RegisterMap(reg_map_file, policy_file_name)
+        # optional directory to cache the parsed map in, so large XML maps aren't parsed on every start
+        reg_map_cache = options.get("reg_map_cache")
+        self.register_map = RegisterMap.load_or_parse(reg_map_file, policy_file_name, reg_map_cache)
+        self.registers = self.register_map.registers
+        if self.read_on_open:
+            # read every readable register in as few transactions as possible when the device is opened
+            self._open_batches = self.create_read_batches([reg for reg in self.registers.values() if reg.read])
 
         self.polled_registers: list[Register] = []
+        self.background_polling: threading.Thread | None = None
+        self._stop_polling = threading.Event()
 
         # initialise the accessor
         self.accessor: RegisterAccessor = accessorType(**options)
+        # held while polling, so the device can't be opened or closed in the middle of a poll
+        self.accessor_lock = threading.Lock()
 
         # initialise the Param Tree
         tree = {}
         tree["control"] = {
             "open": (None, lambda _: self.open_device()),
-            "close": (None, lambda _: self.accessor.close()),
+            "close": (None, lambda _: self.close_device()),
             "connected": (lambda: self.accessor.isConnected, None)
         }
 
         tree['registers'] = self.create_paramTree(self.register_map.map)
 
         self.param_tree = ParameterTree(tree)
+        # getters for each leaf param, so repeated GETs of a single value can skip walking the tree
+        self._leaf_getters = self.index_getters(tree)
+        self._get_cache: dict[str, tuple[str, Callable]] = {}
+        # every branch path in the tree, so subtree lookups for paths that exist can be cached even when empty
+        self._branch_paths = {""}
+        for leaf_path in self._leaf_getters:
+            parts = leaf_path.split("/")
+            self._branch_paths.update("/".join(parts[:depth]) for depth in range(1, len(parts)))
+        # readable immediate registers by path, and the read batches for those under each subtree path requested
+        self._immediate_paths = [(path, reg) for path, reg in self.register_map.get_paths().items()
+                                 if reg.policy is Policy.IMMEDIATE and reg.read]
+        self._subtree_batches: dict[str, list[tuple[int, int, list[tuple[Register, int]]]]] = {}
+        self._prefetched = False  # set while getting a subtree whose immediate registers have already been read
 
-        # calc frequency needed for callback so every desired polling frequency is covered
         if self.polled_registers:
-            all_freq = [reg.poll_freq for reg in self.polled_registers]
-            poll_freq = math.gcd(*all_freq)
-            logging.debug("Polling loop frequency is %d", poll_freq)
-            self.background_polling = PeriodicCallback(self.polling_loop, poll_freq)
+            # registers are only batched with others polled at the same rate, so none are read more often than configured
+            by_freq: dict[int, list[Register]] = {}
+            for reg in self.polled_registers:
+                by_freq.setdefault(reg.poll_freq, []).append(reg)
+            # each batch gets a preallocated buffer to read into
+            self._poll_batches = [(start, bytearray(size), regs, freq) for freq, regs in by_freq.items()
+                                  for start, size, regs in self.create_read_batches(regs)]
+            # min-heap of (next due time, batch index), so each poll only looks at the batches that are due
+            self._poll_heap = [(0, index) for index in range(len(self._poll_batches))]
+            self._min_poll_period = min(batch[3] for batch in self._poll_batches)
+            # polling runs in its own thread, so slow device reads don't hold up the IOLoop
+            self.background_polling = threading.Thread(target=self.polling_thread, daemon=True)
             self.background_polling.start()
 
     def initialize(self, adapters):
@@ -104,23 +121,83 @@ class RegisterAccessorController(BaseController):
 
     def cleanup(self):
         logging.info("Cleaning up RegisterAccessorController")
-        self.background_polling.stop()
-        if self.accessor.isConnected:
-            self.accessor.close()
+        if self.background_polling:
+            self._stop_polling.set()
+            self.background_polling.join()
+        self.close_device()
 
     def get(self, path, with_metadata=False):
+        if not with_metadata:
+            cached = self._get_cache.get(path)
+            if cached is not None:
+                key, getter = cached
+                return {key: getter()}
+        batches = self.get_subtree_batches(path) if self._immediate_paths else None
         try:
-            return self.param_tree.get(path, with_metadata)
+            if batches and self.accessor.isConnected:
+                # read every immediate register in the subtree in as few transactions as possible,
+                # rather than once per register (or per field) as the tree is populated
+                self.read_batches(batches)
+                self._prefetched = True
+            result = self.param_tree.get(path, with_metadata)
         except ParameterTreeError as error:
-            logging.error(error)
-            raise ControllerError(error)
+            self._raise_tree_error(error)
+        finally:
+            self._prefetched = False
+        if not with_metadata:
+            getter = self._leaf_getters.get(path.strip("/"))
+            if getter is not None and len(result) == 1:
+                # remember the key the tree used for this leaf, so cached responses match its format
+                self._get_cache[path] = (next(iter(result)), getter)
+        return result
 
     def set(self, path, data):
         try:
             self.param_tree.set(path, data)
         except ParameterTreeError as error:
-            logging.error(error)
-            raise ControllerError(error)
+            self._raise_tree_error(error)
+
+    def _raise_tree_error(self, error: ParameterTreeError):
+        logging.error(error)
+        raise ControllerError(error)
+
+    def get_subtree_batches(self, path: str) -> list[tuple[int, int, list[tuple[Register, int]]]]:
+        """
+        Get the read batches for the readable immediate registers that a GET of the path will read
+        """
+        path = path.strip("/")
+        batches = self._subtree_batches.get(path)
+        if batches is None:
+            if path in self._leaf_getters:
+                return []  # a single param, so there is nothing to batch
+            if path in ("", "registers"):
+                regs = [reg for _, reg in self._immediate_paths]
+            elif path.startswith("registers/"):
+                sub = path[len("registers/"):]
+                # registers inside the requested subtree, or the register the requested subtree (e.g. its fields) is in
+                regs = [reg for reg_path, reg in self._immediate_paths
+                        if reg_path == sub or reg_path.startswith(sub + "/") or sub.startswith(reg_path + "/")]
+            else:
+                regs = []
+            batches = self.create_read_batches(regs) if regs else []
+            if path in self._branch_paths:  # don't keep entries for paths that don't exist
+                self._subtree_batches[path] = batches
+        return batches
+
+    def index_getters(self, tree: dict) -> dict[str, Callable]:
+        """
+        Flatten a Param Tree style dictionary into the getter of each leaf parameter, keyed by its full path
+        """
+        getters = {}
+        stack = [("", tree)]
+        while stack:
+            prefix, node = stack.pop()
+            for key, value in node.items():
+                if isinstance(value, dict):
+                    stack.append((prefix + key + "/", value))
+                elif isinstance(value, tuple) and callable(value[0]):
+                    getters[prefix + key] = value[0]
+        return getters
     
     def create_paramTree(self, node: dict | Register):
         if isinstance(node, dict):
@@ -139,130 +216,265 @@ class RegisterAccessorController(BaseController):
         about the Register. It also provides a **Fields** subtree if bitfields are defined for the register.
         :rtype: RegisterParamTree
         """
+        # callbacks bind the register (and field mask/shift) as default args, rather than using partials,
+        # to keep the overhead of each ParamTree get/set to a minimum
         read_accessor = self.create_read_access_param(reg)
         tree: RegisterParamTree
         tree = {
             "value": (
                 read_accessor,
-                None if not reg.write else partial(self.write_register, register=reg),
+                None if not reg.write else lambda value, _reg=reg: self.write_register(value, _reg),
                 {"description": reg.desc}
             ),
             "address": (lambda: reg.addr, None),
-            "access_policy": (lambda: reg.policy, None)
+            "access_policy": (lambda: reg.policy.name.lower(), None)
         }
         if reg.bitFields:
             tree['fields'] = {
                 bit.name: (
-                    partial(self.read_field, register=reg, bitField=bit),
-                    None if not bit.write else partial(self.write_field, register=reg, bitField=bit),
+                    self.create_field_read_param(reg, bit),
+                    None if not bit.write else lambda value, _reg=reg, _bit=bit: self.write_field(value, _reg, _bit),
                     {"description": bit.desc,
                      "min": 0,
-                     "max": bit.mask >> _get_bitwise_trailing_zeros(bit.mask)}
-                ) for bit in reg.bitFields
+                     "max": bit.mask >> bit.shift}
+                ) for bit in reg.bitFields.values()
             }
         return tree
     
+    def create_field_read_param(self, reg: Register, bit: BitField):
+        """
+        Create the GET ParamTree Access method for a bitfield. For registers wider than 64 bits, fields within
+        a single 32 bit word are extracted from just that word, rather than masking the register's whole (bignum) value
+        """
+        if reg.size > 8 and bit.word_index >= 0 and _BYTEORDER == "little":
+            unpack = _WORD_STRUCT.unpack_from
+            return (lambda _reg=reg, _offset=bit.word_index * 4, _mask=bit.word_mask, _shift=bit.word_shift:
+                    (unpack(_reg.value, _offset)[0] & _mask) >> _shift)
+        return lambda _reg=reg, _mask=bit.mask, _shift=bit.shift: (_reg.int_value & _mask) >> _shift
+
     def create_read_access_param(self, reg: Register):
         """
         Create the GET ParamTree Access method for the provided register. Access can be done in a few ways:
         - Static: only read from the actual register once and saves it. Afterwards, just return the saved value.
-        - Polled: The Adapter will read the register in a PeriodicCallback. The Frequency of which can be customised per register
+        - Polled: The Adapter will read the register in a background thread. The Frequency of which can be customised per register
         - Immediate: The adapter will always read the register value directly from the hardware. This should be limited to avoid strain on the system
         """
-        policy = reg.policy or self.access_policy
-        reg.policy = policy
+        if reg.policy is None:
+            reg.policy = self.access_policy
         frequency = max(reg.poll_freq or self.poll_rate, 100)  # setting a minimum frequency of 100
-        
-        if policy.lower() in ["immediate", "direct"]:
-            logging.debug("Creating Immediate access param for register %s", reg.name)
-            return partial(self.immediate_reg_read, register=reg)
-        elif policy.lower() in ["static", "once"]:
-            return partial(self.static_reg_read, register=reg)
-        elif policy.lower() in ["polled", "looped"]:
-            logging.debug("Creating Polled access param for register %s, at a frequency of %dms", reg.name, frequency)
-            reg.poll_freq = frequency
-            self.polled_registers.append(reg)
-            return partial(self.static_reg_read, register=reg)
-        else:
-            raise ControllerError("Access Policy '%s' not recognised for register %s at addr %X", policy, reg.name, reg.addr)
+
+        return self._POLICY_DISPATCH[reg.policy](self, reg, frequency)
+
+    def _make_immediate_param(self, reg: Register, frequency: int):
+        logging.debug("Creating Immediate access param for register %s", reg.name)
+        return lambda _reg=reg: self.immediate_reg_read(_reg)
+
+    def _make_static_param(self, reg: Register, frequency: int):
+        return lambda _reg=reg: self.static_reg_read(_reg)
+
+    def _make_polled_param(self, reg: Register, frequency: int):
+        logging.debug("Creating Polled access param for register %s, at a frequency of %dms", reg.name, frequency)
+        reg.poll_freq = frequency
+        self.polled_registers.append(reg)
+        return lambda _reg=reg: self.static_reg_read(_reg)
+
+    # lookup of access policies to the method that creates their GET ParamTree Access method
+    _POLICY_DISPATCH: dict[Policy, Callable[["RegisterAccessorController", Register, int], Callable[[], int]]] = {
+        Policy.IMMEDIATE: _make_immediate_param,
+        Policy.STATIC: _make_static_param,
+        Policy.POLLED: _make_polled_param
+    }
 
     def static_reg_read(self, register: Register):
         """
         Statically read the Register value. If the value has already been read, return local copy.
         Otherwise, read from the register and save the value locally
         """
-        if not register.value and self.accessor.isConnected:  # is the reg bytearray empty? is the accessor open?
-            logging.debug("First Read on %s reg %s", register.policy, register.name)
-            register.value = self.accessor.read(register.addr, register.size)
-        return int.from_bytes(register.value, sys.byteorder)
+        if not register.loaded and self.accessor.isConnected:  # has the reg been read yet? is the accessor open?
+            logging.debug("First Read on %s reg %s", register.policy.name, register.name)
+            self.accessor.read_into(register.addr, register.value)
+            register.update_from_buffer()
+        return register.int_value
 
     def immediate_reg_read(self, register: Register):
         """
         Directly read the register value. This always reads from the actual device, and so should rarely be used in the Param Tree
         """
-        if isinstance(register, int):
-            reg = self.registers.get(register)
-            if reg is None:
-                raise ControllerError("Unable to read address %X: Not found in register map", register)
+        if register.read:
+            if self.accessor.isConnected and not self._prefetched:
+                self.accessor.read_into(register.addr, register.value)
+                register.update_from_buffer()
+            return register.int_value
         else:
-            reg = register
+            raise ControllerError("Unable to read register %s: Register not readable", register.name)
 
-        if reg.read:
-            if self.accessor.isConnected:
-                reg.value = self.accessor.read(reg.addr, reg.size)
-            return int.from_bytes(reg.value, sys.byteorder)
-        else:
-            raise ControllerError("Unable to read register %s: Register not readable", reg.name)
+    def immediate_addr_read(self, addr: int):
+        """
+        Directly read the value of the register at an address, as with `immediate_reg_read`
+        """
+        reg = self.registers.get(addr)
+        if reg is None:
+            raise ControllerError("Unable to read address %X: Not found in register map", addr)
+        return self.immediate_reg_read(reg)
 
-    def write_register(self, value: int | bytes, register: Register):
+    def write_register(self, value: int | bytes, register: Register, refresh: bool | None = None):
         """
         Write to the register. this will always be a write directly to the hardware, no matter the registers Access Policy
         
         Parameters:
             value: The data to write to the register, as a integer that will become a bytearray
-
+            refresh: If True, readable registers are read back after the write to update the local value.
+                If False, the written value is assumed to be the register's new value.
+                If None, the register's readback_after_write setting is used
 
         """
         if register.write and self.accessor.isConnected:
             if type(value) is int:
-                byteVal = int.to_bytes(value, register.size, sys.byteorder)
+                byteVal = int.to_bytes(value, register.size, _BYTEORDER)
             elif type(value) is bytes:
                 byteVal = value
             else:
                 raise ControllerError("Invalid Register Value Type: %s", type(value))
             logging.debug("Writing 0x%s to register %s", byteVal.hex().upper(), register.name)
             self.accessor.write(register.addr, byteVal)
-            if register.read:  # some registers can be write only.
-                register.value = self.accessor.read(register.addr, register.size)
+            if refresh is None:
+                refresh = register.readback_after_write
+            if refresh and register.read:  # some registers can be write only.
+                self.accessor.read_into(register.addr, register.value)
+                register.update_from_buffer()
+            elif type(value) is int:
+                register.update_from_int(value)
             else:
-                register.value = byteVal
+                register.value[:] = byteVal
+                register.update_from_buffer()
         else:
             raise ControllerError("Unable to write to register %s: %s", register.name,
                                   "Not connected" if register.write else "Register not writeable")
 
-    def read_field(self, register: "Register", bitField: BitField) -> int:
-        val = int.from_bytes(register.value, sys.byteorder)
-        # get shift value
-        mask = bitField.mask
-        shift = _get_bitwise_trailing_zeros(mask)
-        return (val & mask) >> shift  # bitwise AND and then right shift to remove mask offset
-
     def write_field(self, value: int, register: "Register", bitField: "BitField"):
-        mask = bitField.mask
-        shift = _get_bitwise_trailing_zeros(mask)
-        start_val = int.from_bytes(register.value, sys.byteorder) & (~mask)  # get the reg value, but 0 out the bits this field relates to
-        write_val = start_val | ((value << shift) & mask)  # shift the write val based on the mask, to position the bits correctly
-
+        if register.size > 8 and bitField.word_index >= 0 and _BYTEORDER == "little":
+            # only the 32 bit word holding the field needs to change, so write just that word
+            # rather than converting and writing the whole (bignum) register value
+            return self.write_field_word(value, register, bitField)
+        self.load_before_modify(register)
+        start_val = register.int_value & bitField.inv_mask  # get the reg value, but 0 out the bits this field relates to
+        write_val = start_val | ((value << bitField.shift) & bitField.mask)  # shift the write val based on the mask, to position the bits correctly
+
+        # the rest of the register value is already known, so only read it back if the register doesn't hold written values
         self.write_register(write_val, register)
 
+    def load_before_modify(self, register: Register):
+        """
+        Read the register from the device before part of it is modified, unless its saved value is known to be current:
+        it has been read or written before, and isn't an immediate register that could have changed since
+        """
+        if (not register.loaded or register.policy is Policy.IMMEDIATE) and register.read and self.accessor.isConnected:
+            self.accessor.read_into(register.addr, register.value)
+            register.update_from_buffer()
+
+    def write_field_word(self, value: int, register: Register, bitField: BitField):
+        """
+        Write a bitfield of a wide register by writing only the 32 bit word that contains it.
+        The field must not span multiple words
+        """
+        if not (register.write and self.accessor.isConnected):
+            raise ControllerError("Unable to write to register %s: %s", register.name,
+                                  "Not connected" if register.write else "Register not writeable")
+        self.load_before_modify(register)
+        offset = bitField.word_index * 4
+        word = _WORD_STRUCT.unpack_from(register.value, offset)[0] & ~bitField.word_mask
+        word |= (value << bitField.word_shift) & bitField.word_mask
+        self.accessor.write(register.addr + offset, _WORD_STRUCT.pack(word))
+        if register.readback_after_write and register.read:
+            self.accessor.read_into(register.addr, register.value)
+        else:
+            _WORD_STRUCT.pack_into(register.value, offset, word)
+        register.update_from_buffer()
+
+    def create_read_batches(self, registers: list[Register]) -> list[tuple[int, int, list[tuple[Register, int]]]]:
+        """
+        Group registers into batches of contiguous addresses, so that each batch can be read from the device
+        in a single transaction rather than one per register.
+
+        :param registers: The registers to group
+        :type registers: list[Register]
+        :return: A list of (start address, size in bytes, [(register, offset of register within batch)]) tuples
+        :rtype: list[tuple[int, int, list[tuple[Register, int]]]]
+        """
+        batches: list[tuple[int, int, list[tuple[Register, int]]]] = []
+        for reg in sorted(registers, key=lambda r: r.addr):
+            if batches and reg.addr <= batches[-1][0] + batches[-1][1]:
+                # register is adjacent to (or overlapping) the previous batch, so extend it
+                start, size, regs = batches[-1]
+                regs.append((reg, reg.addr - start))
+                batches[-1] = (start, max(size, reg.addr + reg.size - start), regs)
+            else:
+                batches.append((reg.addr, reg.size, [(reg, 0)]))
+        logging.debug("%d registers grouped into %d batches", len(registers), len(batches))
+        return batches
+
     def open_device(self):
-        self.accessor.open()
+        with self.accessor_lock:
+            self.accessor.open()
+            if self.read_on_open:
+                self.read_batches(self._open_batches)
 
-    def polling_loop(self):
-        if self.accessor.isConnected:
-            timestamp = int(time.time() * 1000)  # milliseconds since epoch
-            for reg in self.polled_registers:
-                if reg.timeLastRead + reg.poll_freq < timestamp:
-                    reg.value = self.accessor.read(reg.addr, reg.size)
-                    reg.timeLastRead = timestamp
+    def read_batches(self, batches: list[tuple[int, int, list[tuple[Register, int]]]]):
+        """
+        Read batches of registers from the device, one transaction per batch, and split the data between the registers
+
+        :param batches: The batches to read, as created by `create_read_batches`
+        :type batches: list[tuple[int, int, list[tuple[Register, int]]]]
+        """
+        for start, size, regs in batches:
+            buf = bytearray(size)
+            self.accessor.read_into(start, buf)
+            for reg, offset in regs:
+                reg.value[:] = buf[offset:offset + reg.size]
+                reg.update_from_buffer()
+
+    def close_device(self):
+        with self.accessor_lock:
+            if self.accessor.isConnected:
+                self.accessor.close()
+
+    def polling_thread(self):
+        """
+        Background thread target that runs the polling loop, sleeping until the next batch is due,
+        until cleanup is called
+        """
+        delay = 0
+        while not self._stop_polling.wait(delay / 1000):
+            try:
+                delay = self.polling_loop()
+            except Exception as error:
+                logging.error("Error polling registers: %s", error)
+                delay = self._min_poll_period
+
+    def polling_loop(self) -> int:
+        """
+        Read any polled batches that are due.
+
+        :return: Time in milliseconds until the next batch is due
+        :rtype: int
+        """
+        with self.accessor_lock:
+            if not self.accessor.isConnected:
+                return self._min_poll_period
+            timestamp = time.monotonic_ns() // 1_000_000  # monotonic milliseconds, unaffected by wall clock changes
+            heap = self._poll_heap
+            while heap and heap[0][0] <= timestamp:
+                _, index = heapq.heappop(heap)
+                start, buf, regs, period = self._poll_batches[index]
+                try:
+                    # read the whole batch at once, then split it between the registers
+                    self.accessor.read_into(start, buf)
+                    for reg, offset in regs:
+                        reg.value[:] = buf[offset:offset + reg.size]
+                        reg.update_from_buffer()
+                        reg.timeLastRead = timestamp
+                finally:
+                    # rescheduled even if the read fails, so the batch is retried rather than dropped
+                    heapq.heappush(heap, (timestamp + period, index))
+            return heap[0][0] - timestamp if heap else self._min_poll_period
 
@@ -1,12 +1,10 @@
 import sys
 import logging
-import json
 import pathlib
 
-from xml.etree import ElementTree as ET
 from argparse import ArgumentParser
 
-from RegisterAccessor.RegisterMap import RegisterMap, RegisterEncoder
+from RegisterAccessor.RegisterMap import RegisterMap
 
 
 # attribute key consts for the XMl parsing, based on the XML firmware file
@@ -33,6 +31,8 @@ class Config():
                             choices=["static", "polled", "immediate"])
         parser.add_argument("--poll_rate", "-r", default=1000, help="Default polling rate for all registers, in milliseconds")
         parser.add_argument("--dest", help="Filepath for the outputted JSON register map")
+        parser.add_argument("--force", "-f", action="store_true",
+                            help="Regenerate the JSON register map even if it is newer than the source files")
 
         (arg_config, _) = parser.parse_known_args(argv)
         arg_config = vars(arg_config)
@@ -44,6 +44,17 @@ class Config():
         
         self.default_policy = arg_config.get("policy")
         self.default_poll_rate = arg_config.get("poll_rate")
+        self.force = arg_config.get("force")
+
+    def is_up_to_date(self) -> bool:
+        """Check if the destination JSON map exists, and is newer than the map file and policy file it is made from"""
+        dest = pathlib.Path(self.dest_filename)
+        if not dest.is_file():
+            return False
+        dest_mtime = dest.stat().st_mtime
+        sources = [pathlib.Path(src) for src in (self.map_src_filename, self.policy_filename) if src]
+        # a missing source is never up to date, so RegisterMap gets to report it
+        return all(src.is_file() and src.stat().st_mtime < dest_mtime for src in sources)
 
 
 
@@ -54,10 +65,14 @@ def main(argv=None):
     logging.basicConfig(level=logging.DEBUG)
     config = Config(argv)
 
+    if not config.force and config.is_up_to_date():
+        logging.info("%s is already up to date, use --force to regenerate it", config.dest_filename)
+        return 0
+
     reg_tree = RegisterMap(config.map_src_filename, config.policy_filename)
 
     with open(config.dest_filename, "w") as outfile:
-        json.dump(reg_tree.map, outfile, indent=2, cls=RegisterEncoder)
+        outfile.write(reg_tree.get_schema())
         logging.info("File output to %s", config.dest_filename)
 
 
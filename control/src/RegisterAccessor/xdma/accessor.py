@@ -5,6 +5,9 @@ import os
 from pathlib import Path
 import logging
 
+# prefault the mapping's page tables when it is created, rather than on first access to each page. Linux only
+_MAP_POPULATE = getattr(mmap, "MAP_POPULATE", 0)
+
 
 class XdmaException(RegisterAccessorException):
     pass
@@ -15,36 +18,49 @@ class XDmaAccessor(RegisterAccessor):
     def __init__(self, **kwargs):
         super().__init__()
         self.device_index = kwargs.get("device_index", 0)
+        # other devices may need to be opened? such as the interrupts for DMA
+        self.dev_name = "xdma{}_user".format(self.device_index)
+        self.dev_path = Path("/dev").joinpath(self.dev_name)
         self.device_size = int(kwargs.get("device_size", 1048576))  # TODO: find better means of setting default size. mmap docs say you should be able to set this to 0, but that causes an error
         self.memory = None
+        self.view: memoryview | None = None  # shared view of the memory map, so accesses don't copy through mmap methods
         self.dev_file = None
 
     def open(self) -> None:
         logging.debug("Opening XDMA Device")
-        dev_name = "xdma{}_user".format(self.device_index)
-        # other devices may need to be opened? such as the interrupts for DMA
-        dev_path = Path("/dev")
-
-        fullpath = dev_path.joinpath(dev_name)
-
-        if dev_path.is_dir() and fullpath.is_char_device():  # the XDMA dev files are character devices, not standard files.
-            self.dev_file = os.open(fullpath, os.O_RDWR)
-            self.memory = mmap.mmap(fileno=self.dev_file, length=self.device_size)
-            self._isConnected = True
-        else:
-            raise XdmaException("XDMA device {} not found. Check that xdma is installed and the device is available.".format(dev_name))
+        try:
+            self.dev_file = os.open(self.dev_path, os.O_RDWR)
+        except OSError as error:
+            raise XdmaException("XDMA device {} not found. Check that xdma is installed and the device is available. ({})".format(
+                self.dev_name, error.strerror))
+        try:
+            self.memory = mmap.mmap(fileno=self.dev_file, length=self.device_size,
+                                    flags=mmap.MAP_SHARED | _MAP_POPULATE, prot=mmap.PROT_READ | mmap.PROT_WRITE)
+        except (OSError, ValueError) as error:
+            os.close(self.dev_file)
+            raise XdmaException("Unable to map XDMA device {}: {}".format(self.dev_name, error))
+        if hasattr(mmap, "MADV_WILLNEED"):
+            try:
+                self.memory.madvise(mmap.MADV_WILLNEED)
+            except OSError as error:
+                # only a hint, and some drivers don't support it for their mappings
+                logging.debug("madvise not supported for XDMA mapping: %s", error)
+        self.view = memoryview(self.memory)
+        self._isConnected = True
 
     def close(self):
         logging.debug("Closing XDMA Device")
         if self.isConnected:
+            self.view.release()  # the map can't be closed while the view is exported
+            self.view = None
             self.memory.close()
             os.close(self.dev_file)
             self._isConnected = False
     
     def read(self, addr: int, size: int) -> bytearray:
         """
-        Read from the memory map, using Seek Read methods rather than slicing,
-        as these provide additional error handling
+        Read from the memory map into a new bytearray. The data is copied straight from the map into
+        the bytearray, rather than through an intermediate bytes object
 
         Parameters:
             addr: the address to read from
@@ -53,17 +69,29 @@ class XDmaAccessor(RegisterAccessor):
         Returns:
             a bytearray of length <size>, containing the read data
         """
+        read_reg = bytearray(size)
+        self.read_into(addr, read_reg)
+        return read_reg
+    
+    def read_into(self, addr: int, buf: bytearray) -> None:
+        """
+        Read from the memory map directly into a preallocated buffer, without creating an intermediate copy
+
+        Parameters:
+            addr: the address to read from
+            buf: a writeable bytearray, or other byte-like-object, that will be filled with the read data
+        """
         if not self.isConnected:
             raise XdmaException("DEVICE NOT CONNECTED")
-        self.memory.seek(addr)
-        read_reg = self.memory.read(size)
-        self.memory.seek(0)
-        return bytearray(read_reg)
-    
+        with memoryview(buf) as dest:
+            size = len(dest)
+            if addr < 0 or addr + size > self.device_size:
+                raise XdmaException("Read of {} bytes at 0x{:X} is outside the device memory".format(size, addr))
+            dest[:] = self.view[addr:addr + size]
+
     def write(self, addr: int, data: bytearray) -> None:
         """
-        Write to the memory map, using the Seek and Read methods rather than slicing,
-        as these can provide additional error handling
+        Write to the memory map through the shared view, without copying the data first
 
         Parameters:
             addr: the address to write to
@@ -71,6 +99,7 @@ class XDmaAccessor(RegisterAccessor):
         """
         if not self.isConnected:
             raise XdmaException("DEVICE NOT CONNECTED")
-        self.memory.seek(addr)
-        self.memory.write(data)
-        self.memory.seek(0)
+        size = len(data)
+        if addr < 0 or addr + size > self.device_size:
+            raise XdmaException("Write of {} bytes at 0x{:X} is outside the device memory".format(size, addr))
+        self.view[addr:addr + size] = data